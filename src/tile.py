@@ -14,9 +14,9 @@ sys.stdout.write("\n##### Tile Utilities ####\n\n")
 t = tile_tools.TileDownloadJob(sys.argv[2], TILE_SETS[sys.argv[1]])
 
 if sys.argv[3] == "count_tiles":
-    print "Total tiles in area:\t", (t.counts["exists"] + t.counts["download"])
-    print "Already downloaded:\t", t.counts["exists"]
-    print "Need downloaded:\t", t.counts["download"]
+    print("Total tiles in area:\t", (t.counts["exists"] + t.counts["download"]))
+    print("Already downloaded:\t", t.counts["exists"])
+    print("Need downloaded:\t", t.counts["download"])
 
 elif sys.argv[3] in ["download", "proxy_download"]:
     sys.stdout.write("Tiles within extents: {}\n".format(t.counts["download"] + t.counts["exists"]))
@@ -42,6 +42,10 @@ elif sys.argv[3] == "create_viewer":
 elif sys.argv[3] == "mbtiles":
     t.write_mbtiles()
 
+elif sys.argv[3] == "mbtiles_download":
+    sys.stdout.write("Downloading straight into mbtiles....\n")
+    t.get_tiles(mbtiles=True)
+
 elif sys.argv[3] == "geotiff":
     sys.stdout.write("Creating GeoTiff....\n")
     s = tile_tools.TileStitchJob(t)
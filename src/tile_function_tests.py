@@ -3,9 +3,12 @@
 #   Copyright (c) 2016, Thomas McAdam. All rights reserved.     #
 #################################################################
 
+import os
+import shutil
+import tempfile
 import unittest
 
-from tile_tools import Tile, Provider, TileSet
+from tile_tools import Tile, Provider, TileSet, MBTilesStore
 
 
 class TileSetTest(unittest.TestCase):
@@ -148,6 +151,44 @@ class TileTest(unittest.TestCase):
         self.assertAlmostEqual(Tile().lonlat_to_meters(lonlat)[1], 20037508.343, places=3)
 
 
+class MBTilesStoreTest(unittest.TestCase):
+
+    provider = Provider(name="test_name", tile_system="SLIPPY", tile_format="PNG",
+                        url="http://some.tile.url/{zoom}/{x}/{y}.png", attribution="Tests")
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        tileset = TileSet(name="test", version="1", description="test", folder="TEST",
+                          extents=(-37.90932, -37.91144, 145.12877, 145.13168),
+                          zoom_min=13, zoom_max=13, provider=self.provider)
+        self.store = MBTilesStore(os.path.join(self.out_dir, 'test.mbtiles'), tileset)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.out_dir)
+
+    def put_tile(self):
+        tile = Tile(7307, 5032, 13)
+        tile.image = b'png-bytes'
+        self.store.put(tile)
+        return tile
+
+    def test_put_stores_tile_row_in_tms(self):
+        self.put_tile()
+        rows = self.store.conn.execute(
+            "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles").fetchall()
+        self.assertEquals(rows, [(13, 7307, 3159, b'png-bytes')])
+
+    def test_existing_returns_slippy_coordinates(self):
+        self.put_tile()
+        self.assertEquals(self.store.existing(), {(13, 7307, 5032)})
+
+    def test_metadata_table_seeded_from_tileset(self):
+        metadata = dict(self.store.conn.execute("SELECT name, value FROM metadata").fetchall())
+        self.assertEquals(metadata['bounds'], '145.12877,-37.91144,145.13168,-37.90932')
+        self.assertEquals(metadata['name'], 'test')
+
+
 class ProviderTest(unittest.TestCase):
 
     def test(self):
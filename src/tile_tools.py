@@ -7,17 +7,72 @@ import json
 import math
 import random
 import os
+import sqlite3
 import subprocess
 import sys
-import errno
-from StringIO import StringIO
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from string import Template
 
 from datetime import datetime
-import eventlet
-from eventlet.green import urllib2 as evUrllib2
+import aiohttp
+import numpy as np
 from PIL import Image
 
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+# Web Mercator constants, folded once instead of recomputed per call
+_ORIGIN_SHIFT = math.pi * 6378137
+_ORIGIN_OVER_180 = _ORIGIN_SHIFT / 180.0
+_M_PI_360 = math.pi / 360.0
+_180_OVER_PI = 180.0 / math.pi
+
+
+def lonlat_to_meters(lon, lat):
+    """
+    Converts lon/lat (scalars or arrays) in WGS84 Datum to XY in Spherical Mercator EPSG:900913
+    """
+    mx = lon * _ORIGIN_OVER_180
+    my = np.log(np.tan((90 + lat) * _M_PI_360)) * _180_OVER_PI * _ORIGIN_OVER_180
+    return mx, my
+
+
+def xyz_to_lonlat(xs, ys, z):
+    """
+    Converts tile x/y (scalars or arrays) at zoom z to lon/lat of the top-left corners
+    """
+    n = 2.0 ** z
+    lon = xs / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * ys / n))))
+    return lon, lat
+
+
+if numba:
+    # The projection kernels are pure ufunc arithmetic, so when numba is
+    # around compile them to native code for the scalar call sites
+    lonlat_to_meters = numba.njit(cache=True)(lonlat_to_meters)
+    xyz_to_lonlat = numba.njit(cache=True)(xyz_to_lonlat)
+
 
 class Provider:
     """
@@ -32,12 +87,39 @@ class Provider:
         self.url = url
         self.attribution = attribution
         self.balancers = balancers
+        try:
+            # Compile the template once into an f-string closure so gen_url does
+            # not re-parse the format string for every tile
+            self._url_fn = eval("lambda zoom, x, y, b: f'" + url.replace('{balancer}', '{b}') + "'")
+        except Exception:
+            self._url_fn = None
 
     def gen_url(self, tile):
+        balancer = random.choice(self.balancers) if self.balancers else None
+        if self._url_fn:
+            return self._url_fn(tile.z, tile.x, tile.y, balancer)
         if self.balancers:
-            return self.url.format(balancer=random.choice(self.balancers), zoom=tile.z, x=tile.x, y=tile.y)
+            return self.url.format(balancer=balancer, zoom=tile.z, x=tile.x, y=tile.y)
         return self.url.format(zoom=tile.z, x=tile.x, y=tile.y)
 
+    def gen_urls(self, xs, ys, z):
+        """
+        Builds urls for a whole zoom level of x/y arrays in one pass, drawing
+        every balancer choice up front instead of one RNG call per tile
+        """
+        if self.balancers:
+            balancers = random.choices(self.balancers, k=len(xs))
+        else:
+            balancers = [None] * len(xs)
+        if self._url_fn:
+            return [self._url_fn(z, x, y, b)
+                    for x, y, b in zip(xs.tolist(), ys.tolist(), balancers)]
+        if self.balancers:
+            return [self.url.format(balancer=b, zoom=z, x=x, y=y)
+                    for x, y, b in zip(xs.tolist(), ys.tolist(), balancers)]
+        return [self.url.format(zoom=z, x=x, y=y)
+                for x, y in zip(xs.tolist(), ys.tolist())]
+
 
 class Tile:
     """
@@ -52,35 +134,47 @@ class Tile:
         self.z = z
         self.image = None
 
+    @classmethod
+    def from_arrays(cls, xs, ys, z):
+        """
+        Lazily materialises Tile objects from the parallel x/y arrays of one zoom level
+        """
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            yield cls(x=x, y=y, z=z)
+
     def y_tms(self):
         """
         Converts y value of tile into TMS format
         """
         return int(2.0**self.z - self.y - 1)
 
+    @staticmethod
+    def _spread_bits(v):
+        """
+        Spreads the low 32 bits of v so bit i lands at position 2*i (Morton interleave)
+        """
+        v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+        v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+        v = (v | (v << 2)) & 0x3333333333333333
+        v = (v | (v << 1)) & 0x5555555555555555
+        return v
+
     def quad_tree(self):
         """
-        Converts tile into Quadtree notation system (used for systems like Bing)
+        Converts tile into Quadtree notation system (used for systems like Bing).
+        Each base-4 digit of the Morton interleave of (x, y) is one quadkey digit
         """
-        quad_key = ""
-        for i in range(self.z, 0, -1):
-            digit = 0
-            mask = 1 << (i - 1)
-            if (self.x & mask) != 0:
-                digit += 1
-            if (self.y & mask) != 0:
-                digit += 2
-            quad_key += str(digit)
-        return quad_key
+        if self.z == 0:
+            return ""
+        morton = self._spread_bits(self.x) | (self._spread_bits(self.y) << 1)
+        return np.base_repr(morton, base=4).zfill(self.z)
 
     def to_point(self):
         """
         Returns geographical coordinates of the top-left corner of the tile.
         """
-        n = math.pow(2, self.z)
-        longitude = float(self.x) / n * 360.0 - 180.0
-        latitude = math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * float(self.y) / n))))
-        return longitude, latitude
+        return TileSet._compute_xyz_to_lonlat(self.x, self.y, self.z)
 
     def to_rectangle(self):
         """
@@ -92,28 +186,25 @@ class Tile:
         return self.lonlat_to_meters(self.to_point())
 
     def to_rectangle_meters(self):
-        return self.lonlat_to_meters(self.to_rectangle()[0]), self.lonlat_to_meters(self.to_rectangle()[1])
+        top_left, bottom_right = self.to_rectangle()
+        return self.lonlat_to_meters(top_left), self.lonlat_to_meters(bottom_right)
 
     @staticmethod
     def lonlat_to_meters(lonlat):
         """
         Converts given lat/lon in WGS84 Datum to XY in Spherical Mercator EPSG:900913
         """
-        origin_shift = 2 * math.pi * 6378137 / 2.0
         lon, lat = lonlat
-        mx = lon * origin_shift / 180.0
-        my = math.log(math.tan((90 + lat) * math.pi / 360.0)) / (math.pi / 180.0)
-        my = my * origin_shift / 180.0
-        return mx, my
+        return lonlat_to_meters(lon, lat)
 
     def url(self, provider):
         return provider.gen_url(self)
 
     def path(self):
-        return os.path.join(str(self.z), str(self.x), '{}.png'.format(self.y))
+        return f"{self.z}/{self.x}/{self.y}.png"
 
     def full_path(self, tile_job):
-        return os.path.join(tile_job.out_path, tile_job.job_name, self.path())
+        return f"{tile_job.tiles_dir()}/{self.z}/{self.x}/{self.y}.png"
 
     def identifier(self, provider):
         identifier = provider.name.lower() + '_' + str(self.z) + '_'
@@ -141,6 +232,11 @@ class TileSet:
         self.zoom_min = zoom_min
         self.zoom_max = zoom_max
         self.zoom_range = range(zoom_min, zoom_max + 1)
+        # Grid corners per zoom are fixed once the bbox is known, so run the
+        # transcendental-heavy deg2num once per zoom instead of on every call
+        self._grid = {zoom: self.deg2num(self.bbox['n'], self.bbox['w'], zoom) +
+                            self.deg2num(self.bbox['s'], self.bbox['e'], zoom)
+                      for zoom in self.zoom_range}
         self.provider = provider
         self.tiles = self.pop_tileset()
 
@@ -157,13 +253,18 @@ class TileSet:
         return south
 
     def pop_tileset(self):
+        """
+        Builds the per-zoom tile grids as parallel x/y arrays rather than one Tile
+        object per cell, Tile objects are only materialised on demand via Tile.from_arrays
+        """
         tileset = dict()
         for zoom in self.zoom_range:
-            tiles = []
-            for x in self.cols(zoom):
-                for y in self.rows(zoom):
-                    tiles.append(Tile(z=zoom, x=x, y=y))
-            tileset[zoom] = tiles
+            x0, y0 = self.top_left(zoom)
+            x1, y1 = self.bottom_right(zoom)
+            xs, ys = np.meshgrid(np.arange(x0, x1 + 1, dtype=np.int32),
+                                 np.arange(y0, y1 + 1, dtype=np.int32),
+                                 indexing='ij')
+            tileset[zoom] = {'x': xs.ravel(), 'y': ys.ravel()}
         return tileset
 
     def cols(self, zoom):
@@ -173,24 +274,34 @@ class TileSet:
         return range(self.top_left(zoom)[1], self.bottom_right(zoom)[1] + 1)
 
     def bottom_right(self, zoom):
+        if zoom in self._grid:
+            return self._grid[zoom][2:]
         return self.deg2num(self.bbox['s'], self.bbox['e'], zoom)
 
     def top_left(self, zoom):
+        if zoom in self._grid:
+            return self._grid[zoom][:2]
         return self.deg2num(self.bbox['n'], self.bbox['w'], zoom)
 
     def extents_meters(self, zoom):
         x1, y1 = self.top_left(zoom)
         x2, y2 = self.bottom_right(zoom)
-        top_left = Tile(x1, y1, zoom).to_point_meters()
-        bottom_right = Tile(x2, y2, zoom).to_rectangle_meters()[1]
-        return top_left, bottom_right
+        xs = np.array([x1, x2 + 1], dtype=np.float64)
+        ys = np.array([y1, y2 + 1], dtype=np.float64)
+        lon, lat = self._compute_xyz_to_lonlat(xs, ys, zoom)
+        mx, my = lonlat_to_meters(lon, lat)
+        return (mx[0], my[0]), (mx[1], my[1])
+
+    @staticmethod
+    def _compute_xyz_to_lonlat(xs, ys, z):
+        return xyz_to_lonlat(xs, ys, z)
 
     @staticmethod
     def deg2num(lat_deg, lon_deg, zoom):
-        lat_rad = math.radians(lat_deg)
+        lat_rad = np.radians(lat_deg)
         n = 2.0 ** zoom
-        x_tile = int((lon_deg + 180.0) / 360.0 * n)
-        y_tile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+        x_tile = np.floor((np.asarray(lon_deg) + 180.0) / 360.0 * n).astype(np.int64)
+        y_tile = np.floor((1.0 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2.0 * n).astype(np.int64)
         return x_tile, y_tile
 
     def center_x(self):
@@ -203,6 +314,108 @@ class TileSet:
         return (self.zoom_max + self.zoom_min) / 2
 
 
+class TileWriter:
+    """
+    Writes raw tile bytes to disk from a background thread, draining queued
+    writes in batches so the download loop never blocks on the filesystem
+    """
+
+    def __init__(self, batch_size=32, workers=2):
+        self.batch_size = batch_size
+        # Bounded so a slow disk back-pressures the download loop instead of
+        # buffering the whole job in memory
+        self.ops = queue.Queue(maxsize=64)
+        self.threads = [threading.Thread(target=self._drain, daemon=True)
+                        for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, filename, data, encode=False):
+        self.ops.put((filename, data, encode))
+
+    def close(self):
+        for _ in self.threads:
+            self.ops.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _drain(self):
+        finished = False
+        while not finished:
+            op = self.ops.get()
+            if op is None:
+                return
+            batch = [op]
+            while len(batch) < self.batch_size:
+                try:
+                    op = self.ops.get_nowait()
+                except queue.Empty:
+                    break
+                if op is None:
+                    # Each worker consumes exactly one sentinel
+                    finished = True
+                    break
+                batch.append(op)
+            for filename, data, encode in batch:
+                try:
+                    if encode:
+                        Image.open(BytesIO(data)).save(filename, "PNG")
+                        continue
+                    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                    try:
+                        os.write(fd, data)
+                    finally:
+                        os.close(fd)
+                except Exception as e:
+                    # A bad payload (e.g. an HTML error body on the encode
+                    # path) must not kill the worker - with no workers left
+                    # the bounded queue fills and write() would block the
+                    # event loop forever. Log it and keep draining
+                    print("\nFailed to write {}: {}".format(filename, e))
+
+
+class MBTilesStore:
+    """
+    Stores tiles straight into an mbtiles SQLite database instead of one file
+    per tile, batching inserts into transactions to keep writes sequential
+    """
+
+    def __init__(self, filename, tileset, batch_size=500):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.pending = 0
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, "
+                          "tile_column integer, tile_row integer, tile_data blob)")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles "
+                          "(zoom_level, tile_column, tile_row)")
+        self.conn.execute("DELETE FROM metadata")
+        self.conn.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)",
+                              list(MetaData(tileset).META_DATA.items()))
+        self.conn.commit()
+
+    def put(self, tile):
+        self.conn.execute("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, "
+                          "tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                          (tile.z, tile.x, tile.y_tms(), tile.image))
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.conn.commit()
+            self.pending = 0
+
+    def existing(self):
+        """
+        Returns the set of stored (zoom, x, y) in slippy coordinates
+        """
+        return {(z, x, int(2 ** z - row - 1)) for z, x, row in self.conn.execute(
+            "SELECT zoom_level, tile_column, tile_row FROM tiles")}
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
 class TileDownloadJob:
     """
     A download job manages the processing of a Tileset
@@ -213,6 +426,7 @@ class TileDownloadJob:
         self.set_counts()
         self.out_path = out_path
         self.job_name = tileset.folder
+        self._tiles_base = os.path.join(out_path, self.job_name)
         self.tileset = tileset
         self.connections = None
         self.connection_name = None
@@ -233,84 +447,171 @@ class TileDownloadJob:
         self.counts['attempted'] = 0
         self.counts['connection'] = 0
 
-    def gen_download_lists(self):
-
-        def test_file(filename_to_test):
-            if os.path.exists(filename_to_test):
-                return True
-            return False
+    def scan_existing_tiles(self):
+        """
+        Walks the output tree once with os.scandir and returns the set of
+        (zoom, x, y) already on disk, avoiding a stat() call per tile
+        """
+        existing = set()
+        for zoom in self.tileset.zoom_range:
+            zoom_dir = os.path.join(self.tiles_dir(), str(zoom))
+            try:
+                x_entries = os.scandir(zoom_dir)
+            except FileNotFoundError:
+                continue
+            for x_entry in x_entries:
+                try:
+                    y_entries = os.scandir(x_entry.path)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                for y_entry in y_entries:
+                    try:
+                        existing.add((zoom, int(x_entry.name), int(y_entry.name[:-4])))
+                    except ValueError:
+                        continue
+        return existing
 
+    def gen_download_lists(self):
+        existing = self.scan_existing_tiles()
         for zoom in self.tileset.zoom_range:
-            for tile in self.tileset.tiles[zoom]:
-                filename = tile.full_path(self)
-                if not test_file(filename):
-                    self.downloads.append(tile)
-                else:
+            arrays = self.tileset.tiles[zoom]
+            for tile in Tile.from_arrays(arrays['x'], arrays['y'], zoom):
+                if (zoom, tile.x, tile.y) in existing:
                     self.exists.append(tile)
+                else:
+                    self.downloads.append(tile)
         self.counts["download"] = len(self.downloads)
         self.counts["exists"] = len(self.exists)
 
-    def get_tiles(self, proxy=False):
+    def make_tile_dirs(self):
+        """
+        The (zoom, x) directory set is fully known from the tileset, create it
+        once up front instead of an exists/makedirs check per tile
+        """
+        for zoom in self.tileset.zoom_range:
+            for x in self.tileset.cols(zoom):
+                os.makedirs(os.path.join(self.tiles_dir(), str(zoom), str(x)), exist_ok=True)
 
-        def test_path(filename_to_check):
-            if not os.path.exists(os.path.dirname(filename_to_check)):
-                try:
-                    os.makedirs(os.path.dirname(filename_to_check))
-                except OSError as exc:  # Guard against race condition
-                    if exc.errno != errno.EEXIST:
-                        raise
+    def get_tiles(self, proxy=False, mbtiles=False):
 
-        def fetch(tile_to_fetch):
+        async def fetch(session, tile_to_fetch, results):
             try:
-                self.counts['attempted'] += 1
-                self.counts['connection'] += 1
-                tile_to_fetch.image = evUrllib2.urlopen(tile_to_fetch.url(self.tileset.provider)).read()
-                self.counts['found'] += 1
-            except evUrllib2.HTTPError as e:
-                if e.code == 403:
-                    self.counts['blocked'] += 1
-                elif e.code == 404:
-                    self.counts['not_found'] += 1
-                    with open("blank.png", 'rb') as f:
-                        tile_to_fetch.image = f.read()
-                else:
-                    print(e.code)
-            except evUrllib2.URLError as e:
-                print(e)
+                for attempt in range(3):
+                    try:
+                        async with session.get(tile_to_fetch.url(self.tileset.provider),
+                                               timeout=aiohttp.ClientTimeout(total=20)) as response:
+                            if response.status >= 500 and attempt < 2:
+                                # Server hiccup, back off and retry on the kept-alive connection
+                                await asyncio.sleep(2 ** attempt)
+                                continue
+                            if response.status == 200:
+                                tile_to_fetch.image = await response.read()
+                                self.counts['found'] += 1
+                            elif response.status == 403:
+                                self.counts['blocked'] += 1
+                            elif response.status == 404:
+                                self.counts['not_found'] += 1
+                                with open("blank.png", 'rb') as f:
+                                    tile_to_fetch.image = f.read()
+                            else:
+                                print(response.status)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        if attempt < 2:
+                            await asyncio.sleep(2 ** attempt)
+                            continue
+                        print(e)
+                    break
             finally:
-                return tile_to_fetch
-
-        pool = eventlet.GreenPool(25)
-        for tile in pool.imap(fetch, self.downloads):
-            filename = tile.full_path(self)
-            test_path(filename)
-            if tile.image:
-                im = Image.open(StringIO(tile.image))
-                im.save(filename, "PNG")
-                tile.image = None
-                self.exists.append(tile)
-
-            seconds_elapsed = (datetime.now() - self.start_time).total_seconds()
-            tiles_per_min = int((float(self.counts["attempted"]) / seconds_elapsed) * 60)
-            minutes_remaining = int((self.counts['download'] - self.counts['attempted']) / tiles_per_min)
-
-            output = "Attempted: {0}/{1}   Found: {2}   Not found: {3}   Blocked: {4}    " \
-                     "Tiles/Min: {5}({6} mins remaining)".format(self.counts["attempted"],
-                                                                 self.counts["download"],
-                                                                 self.counts["found"],
-                                                                 self.counts['not_found'],
-                                                                 self.counts['blocked'],
-                                                                 tiles_per_min,
-                                                                 minutes_remaining)
-            sys.stdout.write("\r{}".format(output))
-            sys.stdout.flush()
-
-            if proxy and (self.counts['blocked'] > 10 or self.counts['connection'] > 100):
-                self.counts['connection'] = 0
-                self.counts['blocked'] = 0
-                self.reset_vpn()
-                self.gen_lists()
-                return False
+                await results.put(tile_to_fetch)
+
+        async def download_all():
+            results = asyncio.Queue()
+            connector = aiohttp.TCPConnector(limit=16, limit_per_host=16,
+                                             keepalive_timeout=30)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                fetchers = [asyncio.ensure_future(fetch(session, tile, results))
+                            for tile in self.downloads]
+                completed = 0
+                last_progress = 0.0
+                try:
+                    for _ in fetchers:
+                        tile = await results.get()
+                        # Count when a result lands, not at task start - every
+                        # fetch task is created up front, so counting there
+                        # would jump both counters to the full download count
+                        # before any response arrives
+                        self.counts['attempted'] += 1
+                        self.counts['connection'] += 1
+                        filename = tile.full_path(self)
+                        if tile.image:
+                            if store:
+                                store.put(tile)
+                            else:
+                                already_png = provider_is_png or tile.image[:8] == PNG_MAGIC
+                                writer.write(filename, tile.image, encode=not already_png)
+                            tile.image = None
+                            self.exists.append(tile)
+
+                        completed += 1
+                        # Keep terminal writes off the hot path, redraw at most ~10Hz
+                        now = time.monotonic()
+                        if now - last_progress > 0.1 or completed == len(fetchers):
+                            last_progress = now
+                            seconds_elapsed = (datetime.now() - self.start_time).total_seconds()
+                            tiles_per_min = int((float(self.counts["attempted"]) / seconds_elapsed) * 60)
+                            minutes_remaining = int((self.counts['download'] - self.counts['attempted']) / tiles_per_min)
+
+                            output = "Attempted: {0}/{1}   Found: {2}   Not found: {3}   Blocked: {4}    " \
+                                     "Tiles/Min: {5}({6} mins remaining)".format(self.counts["attempted"],
+                                                                                 self.counts["download"],
+                                                                                 self.counts["found"],
+                                                                                 self.counts['not_found'],
+                                                                                 self.counts['blocked'],
+                                                                                 tiles_per_min,
+                                                                                 minutes_remaining)
+                            sys.stdout.write("\r{}".format(output))
+                            sys.stdout.flush()
+
+                        if proxy and (self.counts['blocked'] > 10 or self.counts['connection'] > 100):
+                            return False
+                finally:
+                    for fetcher in fetchers:
+                        fetcher.cancel()
+            return True
+
+        store = None
+        if mbtiles:
+            store = MBTilesStore(os.path.join(self.out_path, '{}.mbtiles'.format(self.job_name)),
+                                 self.tileset)
+            already_stored = store.existing()
+            # The constructor's lists partition against the filesystem tree,
+            # which says nothing about what the database holds - rebuild the
+            # work list from the full tileset, filtered only by stored rows
+            self.downloads = []
+            for zoom in self.tileset.zoom_range:
+                arrays = self.tileset.tiles[zoom]
+                for tile in Tile.from_arrays(arrays['x'], arrays['y'], zoom):
+                    if (zoom, tile.x, tile.y) not in already_stored:
+                        self.downloads.append(tile)
+            self.counts['download'] = len(self.downloads)
+            self.counts['exists'] = len(already_stored)
+        else:
+            self.make_tile_dirs()
+        provider_is_png = self.tileset.provider.tile_format.upper() == "PNG"
+        writer = TileWriter()
+        try:
+            finished = asyncio.run(download_all())
+        finally:
+            writer.close()
+            if store:
+                store.close()
+
+        if not finished:
+            self.counts['connection'] = 0
+            self.counts['blocked'] = 0
+            self.reset_vpn()
+            self.gen_lists()
+            return False
 
         return True
 
@@ -332,26 +633,30 @@ class TileDownloadJob:
         self.connection_name = random.choice(self.connections)
         self.open_vpn()
 
+    viewer_template = None
+
     def write_leaflet_viewer(self):
 
-        with open('viewer.html', 'r') as template_file:
-            viewer = MyTemplate(unicode(template_file.read()))
-            use_tms = 'false'
-            substitutions = {'tiles_dir': self.tiles_dir(),
-                             'tiles_ext': 'png',
-                             'tileset_name': self.job_name,
-                             'tms': use_tms,
-                             'center_x': self.tileset.center_x(),
-                             'center_y': self.tileset.center_y(),
-                             'avg_zoom': self.tileset.avg_zoom(),
-                             'max_zoom': self.tileset.zoom_max
-                             }
-            file_path = os.path.join(self.out_path, '{}.html'.format(self.job_name))
-            with open(file_path, 'w') as fOut:
-                fOut.write(viewer.substitute(substitutions))
+        if TileDownloadJob.viewer_template is None:
+            with open('viewer.html', 'r') as template_file:
+                TileDownloadJob.viewer_template = MyTemplate(template_file.read())
+        viewer = TileDownloadJob.viewer_template
+        use_tms = 'false'
+        substitutions = {'tiles_dir': self.tiles_dir(),
+                         'tiles_ext': 'png',
+                         'tileset_name': self.job_name,
+                         'tms': use_tms,
+                         'center_x': self.tileset.center_x(),
+                         'center_y': self.tileset.center_y(),
+                         'avg_zoom': self.tileset.avg_zoom(),
+                         'max_zoom': self.tileset.zoom_max
+                         }
+        file_path = os.path.join(self.out_path, '{}.html'.format(self.job_name))
+        with open(file_path, 'w') as fOut:
+            fOut.write(viewer.substitute(substitutions))
 
     def tiles_dir(self):
-        return os.path.join(self.out_path, self.job_name)
+        return self._tiles_base
 
     def write_metadata(self):
         metadata = MetaData(self.tileset)
@@ -392,7 +697,7 @@ class TileDownloadJob:
         args.append("-delete")
         subprocess.Popen(args, stdout=subprocess.PIPE)
         ps.wait()
-        print "Deleted files: {}".format(number_deleted)
+        print("Deleted files: {}".format(number_deleted))
 
 
 class TileStitchJob:
@@ -404,6 +709,7 @@ class TileStitchJob:
         self.zoom = self.tileset.zoom_max
         self.px = 256 * len(self.tileset.cols(self.zoom))
         self.py = 256 * len(self.tileset.rows(self.zoom))
+        self.stitched_with_vips = False
 
     def gen_world(self):
         # Crop off the excess space.
@@ -415,31 +721,84 @@ class TileStitchJob:
         return [str(x) + "\n" for x in wld]
 
     def stitch(self):
-        mode = "RGBA"
-        image = Image.new(mode, [self.px, self.py])
-        start = self.tileset.top_left(self.zoom)
-        tiles = self.tileset.tiles[self.zoom]
+        if pyvips:
+            self.stitch_vips()
+        else:
+            self.stitch_numpy()
+
+    def stitch_vips(self):
+        """
+        Streams the mosaic through libvips arrayjoin straight into a tiled
+        pyramidal GeoTiff, peak memory stays at a few strips rather than
+        the whole canvas
+        """
+        cols = self.tileset.cols(self.zoom)
+        rows = self.tileset.rows(self.zoom)
+        tiles = [pyvips.Image.new_from_file(Tile(x, y, self.zoom).full_path(self.job),
+                                            access='sequential')
+                 for y in rows for x in cols]
+        joined = pyvips.Image.arrayjoin(tiles, across=len(cols))
+        joined.tiffsave(self.path + '.tif', tile=True, pyramid=True,
+                        compression='jpeg', Q=75, bigtiff=True)
+        self.stitched_with_vips = True
+        sys.stdout.write("Stitched: {0}/{0}".format(len(tiles)))
+        sys.stdout.flush()
+
+    def stitch_numpy(self):
+        # Back the canvas with a memmap so the OS can page it instead of
+        # holding a multi-GB RGBA image in RAM
+        canvas = np.memmap(self.path + '.raw', dtype=np.uint8, mode='w+',
+                           shape=(self.py, self.px, 4))
+        start_x, start_y = self.tileset.top_left(self.zoom)
+        cols = self.tileset.cols(self.zoom)
+        rows = self.tileset.rows(self.zoom)
         c = 0
-        tile_count = len(tiles)
-        for tile in tiles:
-            path = tile.full_path(self.job)
-            cx = 256 * (tile.x - start[0])
-            cy = 256 * (tile.y - start[1])
-            tile_image = Image.open(path)
-            image.paste(tile_image, (cx, cy))
-            c += 1
-
-            output = "Stitched: {}/{}".format(c, tile_count)
-            sys.stdout.write("\r{}".format(output))
-            sys.stdout.flush()
+        last_progress = 0.0
+        tile_count = len(cols) * len(rows)
+        def load(tile_path):
+            return np.asarray(Image.open(tile_path).convert('RGBA'))
+
+        # Fill one 256px strip of the canvas at a time so only a row of tiles
+        # worth of pages is ever dirty, the rest can be written out and evicted.
+        # libpng releases the GIL, so each row's decodes run on a thread pool
+        # while the strip is filled sequentially
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for y in rows:
+                strip = canvas[256 * (y - start_y):256 * (y - start_y + 1)]
+                paths = [Tile(x, y, self.zoom).full_path(self.job) for x in cols]
+                for x, tile_image in zip(cols, executor.map(load, paths)):
+                    cx = 256 * (x - start_x)
+                    strip[:tile_image.shape[0], cx:cx + tile_image.shape[1]] = tile_image
+                    c += 1
+
+                    # Keep terminal writes off the hot path, redraw at most ~10Hz
+                    now = time.monotonic()
+                    if now - last_progress > 0.1 or c == tile_count:
+                        last_progress = now
+                        output = "Stitched: {}/{}".format(c, tile_count)
+                        sys.stdout.write("\r{}".format(output))
+                        sys.stdout.flush()
+                canvas.flush()
 
         # this should overwrite if it already exists
-        image.save(self.path + '.png')
+        Image.fromarray(canvas).save(self.path + '.png', optimize=False, compress_level=1)
+        del canvas
+        os.remove(self.path + '.raw')
         with open(self.path + '.pngw', 'w') as f:
             f.writelines(self.gen_world())
 
     def convert_tif(self):
-        print '\nConverting to GeoTiff......'
+        print('\nConverting to GeoTiff......')
+        if self.stitched_with_vips:
+            # arrayjoin already wrote the tiled pyramidal tif, just georeference it
+            top_left, bottom_right = self.tileset.extents_meters(self.zoom)
+            args = ['gdal_edit.py', '-a_srs', 'EPSG:3857',
+                    '-a_ullr', str(top_left[0]), str(top_left[1]),
+                    str(bottom_right[0]), str(bottom_right[1]),
+                    self.path + ".tif"]
+            subprocess.call(args)
+            print('Saved stitched map ')
+            return
         try:
             os.remove(self.path + ".tif")
         except OSError as e:
@@ -452,7 +811,7 @@ class TileStitchJob:
         subprocess.call(args)
 
         # Add overviews to give better rendering performance in GIS
-        print '\nAdding overviews......'
+        print('\nAdding overviews......')
         try:
             os.remove(self.path + ".tif.ovr")
         except OSError as e:
@@ -471,7 +830,7 @@ class TileStitchJob:
         os.remove(self.path + ".png")
         os.remove(self.path + ".pngw")
 
-        print 'Saved stitched map '
+        print('Saved stitched map ')
 
 
 class MyTemplate(Template):
@@ -479,6 +838,36 @@ class MyTemplate(Template):
 
     def __init__(self, template_string):
         Template.__init__(self, template_string)
+        self._compiled = self.compile()
+
+    def compile(self):
+        """
+        Converts the @-delimited template into a str.format string once, so
+        each substitute() is a single C-level format pass instead of a regex
+        walk over the whole template
+        """
+        def replace(match):
+            name = match.group('named') or match.group('braced')
+            if name:
+                return '{' + name + '}'
+            if match.group('escaped') is not None:
+                return self.delimiter
+            return match.group()
+
+        try:
+            escaped = self.template.replace('{', '{{').replace('}', '}}')
+            return self.pattern.sub(replace, escaped)
+        except Exception:
+            return None
+
+    def substitute(self, mapping=None, **kws):
+        if mapping is None:
+            mapping = kws
+        elif kws:
+            mapping = {**mapping, **kws}
+        if self._compiled is not None:
+            return self._compiled.format(**mapping)
+        return Template.substitute(self, mapping)
 
 
 class MetaData:
@@ -496,5 +885,10 @@ class MetaData:
         self.META_DATA['attribution'] = tileset.provider.attribution
 
     def write(self, file_path):
-        with open(os.path.join(file_path, 'metadata.json'), 'w') as fp:
-            json.dump(self.META_DATA, fp)
+        filename = os.path.join(file_path, 'metadata.json')
+        if orjson:
+            with open(filename, 'wb') as fp:
+                fp.write(orjson.dumps(self.META_DATA))
+        else:
+            with open(filename, 'w') as fp:
+                json.dump(self.META_DATA, fp)